@@ -1,7 +1,14 @@
+import hashlib
+import os
+import pickle
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from data_utils import read_dataset
 
 
@@ -12,8 +19,11 @@ class ConllDataset(Dataset):
     EOS_token = '<e>'
     START_TAG = '<s>'
 
+    # Vocab creation and encoding of datasets larger than this are distributed to worker processes
+    PARALLEL_MIN_SENTENCES = 10000
+
     def __init__(self, conll_file_path, surface_char2id=None, lemma_char2id=None, morph_tag2id=None,
-                 transformation2id=None, mode='train', max_sentences=0):
+                 transformation2id=None, mode='train', max_sentences=0, mmap=False):
         """Initialize ConllDataset.
 
         Arguments:
@@ -25,7 +35,19 @@ class ConllDataset(Dataset):
             mode (str): 'train' or 'test'. If 'test' vocab dicts will not be updated
             max_sentences (int): Maximum number of sentences to be loaded into dataset.
                 Default is 0 which means no limitation
+            mmap (bool): Default is False. If True the encoded dataset is saved next to the conll file
+                and the next loads with the same arguments memory map it instead of reading the conll file
         """
+        if mmap:
+            cache_key = self._cache_key(conll_file_path, (surface_char2id, lemma_char2id, morph_tag2id,
+                                                          transformation2id), mode, max_sentences)
+            # Each set of arguments has its own cache, so datasets memory mapping another one are not affected
+            cache_dir = os.path.join(conll_file_path + '.cache', cache_key)
+            if self._load_cache(cache_dir, cache_key, (surface_char2id, lemma_char2id, morph_tag2id,
+                                                       transformation2id)):
+                self.mode = mode
+                return
+
         self.sentences = read_dataset(conll_file_path)
         if 0 < max_sentences < len(self.sentences):
             self.sentences = self.sentences[:max_sentences]
@@ -59,6 +81,120 @@ class ConllDataset(Dataset):
         self.mode = mode
         if mode == 'train':
             self.create_vocabs()
+        self._resolve_special_ids()
+
+        # The dataset is static after vocab creation, so every sentence is encoded only once
+        self._materialize_soa()
+        if mmap:
+            self._save_cache(cache_dir, cache_key)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Datasets pickled before the special ids were introduced resolve them on load
+        if not hasattr(self, 'surface_eos_id'):
+            self._resolve_special_ids()
+
+    def _materialize_soa(self):
+        """Encode the sentences into flat arrays and release the `Sentence` objects
+
+        """
+        # (number of words, maximum word length) of each sentence, used for length bucketing
+        self.sentence_lengths = [(len(sentence), max(map(len, sentence.surface_words)))
+                                 for sentence in self.sentences]
+
+        # Encoded ids are stored with the smallest integer type the vocab size permits
+        self._dtypes = tuple(self._smallest_dtype(len(vocab)) for vocab in (
+            self.surface_char2id, self.lemma_char2id, self.morph_tag2id, self.transformation2id))
+
+        self._sentence_offsets, self._fields = self._encode_sentences()
+        self.sentences = None
+
+    @staticmethod
+    def _cache_key(conll_file_path, vocabs, mode, max_sentences):
+        # The cache is valid as long as the conll file and the arguments of the dataset do not change
+        stat = os.stat(conll_file_path)
+        vocabs = tuple(sorted(vocab.items()) if vocab else None for vocab in vocabs)
+        return hashlib.md5(repr((stat.st_mtime_ns, stat.st_size, mode, max_sentences, vocabs)).encode('utf-8')
+                           ).hexdigest()
+
+    def _save_cache(self, cache_dir, cache_key):
+        """Save the encoded arrays as .npy files and the vocabs into cache_dir
+
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        # An existing metadata file would validate the arrays while they are being replaced
+        meta_path = os.path.join(cache_dir, 'meta.pkl')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        arrays = {'sentence_offsets': self._sentence_offsets,
+                  'sentence_lengths': np.array(self.sentence_lengths, dtype=np.int64).reshape(-1, 2)}
+        for field, (values, word_offsets) in enumerate(self._fields):
+            arrays['values_{}'.format(field)] = values
+            arrays['word_offsets_{}'.format(field)] = word_offsets
+        # Files are written to temporary paths and moved in place, replaced files stay intact for their memory maps
+        for name, arr in arrays.items():
+            self._replace_file(os.path.join(cache_dir, name + '.npy'), lambda f: np.save(f, arr))
+        # Metadata is written last, so an interrupted save leaves a cache without metadata which is not loaded
+        meta = {'key': cache_key, 'vocabs': (self.surface_char2id, self.lemma_char2id, self.morph_tag2id,
+                                              self.transformation2id)}
+        self._replace_file(meta_path, lambda f: pickle.dump(meta, f))
+
+    @staticmethod
+    def _replace_file(path, write):
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    def _load_cache(self, cache_dir, cache_key, vocabs):
+        """Memory map the encoded arrays saved by `_save_cache`
+
+        Arguments:
+            cache_dir (str): directory of the cache
+            cache_key (str): key of the dataset arguments, see `_cache_key`
+            vocabs (tuple): vocabs given to the dataset, they are updated with the cached ones
+        Returns:
+            bool: True if the cache is valid and loaded
+        """
+        meta_path = os.path.join(cache_dir, 'meta.pkl')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+        if meta['key'] != cache_key:
+            return False
+
+        def _load(name):
+            return np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+        # The cached vocabs are the ones the arrays are encoded with, in train mode they include the symbols
+        # added by `create_vocabs`. Given vocabs are updated in place as they are on a load without the cache.
+        restored = []
+        for vocab, cached_vocab in zip(vocabs, meta['vocabs']):
+            if vocab:
+                vocab.update(cached_vocab)
+                restored.append(vocab)
+            else:
+                restored.append(cached_vocab)
+        self.surface_char2id, self.lemma_char2id, self.morph_tag2id, self.transformation2id = restored
+        self._resolve_special_ids()
+        self._dtypes = tuple(self._smallest_dtype(len(vocab)) for vocab in (
+            self.surface_char2id, self.lemma_char2id, self.morph_tag2id, self.transformation2id))
+        self.sentence_lengths = [tuple(lengths) for lengths in _load('sentence_lengths').tolist()]
+        self._sentence_offsets = _load('sentence_offsets')
+        self._fields = tuple((_load('values_{}'.format(field)), _load('word_offsets_{}'.format(field)))
+                             for field in range(4))
+        self.sentences = None
+        return True
+
+    def _resolve_special_ids(self):
+        # Special token ids are looked up once here instead of on every encoded sequence
+        self.surface_eos_id = self.surface_char2id[self.EOS_token]
+        self.lemma_start_id = self.lemma_char2id[self.START_TAG]
+        self.lemma_eos_id = self.lemma_char2id[self.EOS_token]
+        self.morph_tag_start_id = self.morph_tag2id[self.START_TAG]
+        self.morph_tag_eos_id = self.morph_tag2id[self.EOS_token]
 
     def create_vocabs(self):
         """Create surface_char2id, lemma_char2id and morph_tag2id vocabs using provided data
@@ -66,29 +202,26 @@ class ConllDataset(Dataset):
         """
         print('Creating vocabs...')
 
-        # Update surface_char2id
-        unique_surfaces = set(chain(*[sentence.surface_words for sentence in self.sentences]))
-        unique_chars = set(chain(*[surface for surface in unique_surfaces]))
-        for ch in unique_chars:
-            self.surface_char2id[ch] = len(self.surface_char2id)
+        surface_chars = set()
+        lemma_chars = set()
+        tags = set()
+        # Chunk results are merged in order, so transformations get the ids of their first occurrence
+        for chunk_surface_chars, chunk_lemma_chars, chunk_tags, chunk_transformations in self._map_chunks(
+                _collect_symbols):
+            surface_chars.update(chunk_surface_chars)
+            lemma_chars.update(chunk_lemma_chars)
+            tags.update(chunk_tags)
+            for _t in chunk_transformations:
+                if _t not in self.transformation2id:
+                    self.transformation2id[_t] = len(self.transformation2id)
 
-        # Update lemma_char2id
-        unique_lemmas = set(chain(*[sentence.lemmas for sentence in self.sentences]))
-        unique_chars = set(chain(*[lemma for lemma in unique_lemmas]))
-        for ch in unique_chars:
+        # Update surface_char2id, lemma_char2id and morph_tag2id
+        # Symbols are sorted so that ids do not depend on set iteration order
+        for ch in sorted(surface_chars):
+            self.surface_char2id[ch] = len(self.surface_char2id)
+        for ch in sorted(lemma_chars):
             self.lemma_char2id[ch] = len(self.lemma_char2id)
-
-        # Update transformation2id
-        for sentence in self.sentences:
-            for transformation in sentence.transformations:
-                for _t in transformation:
-                    if _t not in self.transformation2id:
-                        self.transformation2id[_t] = len(self.transformation2id)
-
-        # Update morph_tag2id
-        unique_morph_tags = list(chain(*[sentence.morph_tags for sentence in self.sentences]))
-        unique_tags = set(chain(*[morph_tag for morph_tag in unique_morph_tags]))
-        for tag in unique_tags:
+        for tag in sorted(tags):
             self.morph_tag2id[tag] = len(self.morph_tag2id)
         print('Surface Chars={}, Lemma Chars={}, Transformations={}, tags={}'.format(
             len(self.surface_char2id), len(self.lemma_char2id), len(self.transformation2id), len(self.morph_tag2id)
@@ -96,49 +229,407 @@ class ConllDataset(Dataset):
 
 
     @staticmethod
-    def encode(seq, vocab, add_start_tag=False, add_end_tag=True):
-        res = []
-        if add_start_tag:
-            res.append(vocab[ConllDataset.START_TAG])
-        for token in seq:
-            if token in vocab:
-                res.append(vocab[token])
-        if add_end_tag:
-            res.append(vocab[ConllDataset.EOS_token])
-        return torch.tensor(res, dtype=torch.long)
+    def encode(seq, vocab, start_id=None, end_id=None):
+        """Encode a sequence of tokens into ids
+
+        Arguments:
+            seq (iterable): tokens to be encoded, unknown tokens are skipped
+            vocab (dict): token to id mapping
+            start_id (int): Default is None. If given, prepended to the encoded sequence
+            end_id (int): Default is None. If given, appended to the encoded sequence
+        Returns:
+            list: token ids
+        """
+        # A single vocab lookup per token runs inside builtin map
+        res = [token_id for token_id in map(vocab.get, seq) if token_id is not None]
+        if start_id is not None:
+            res.insert(0, start_id)
+        if end_id is not None:
+            res.append(end_id)
+        return res
+
+    def make_length_sampler(self, batch_size, k=50):
+        """Create a batch sampler which groups sentences with similar lengths
+
+        Arguments:
+            batch_size (int): Number of sentences in a batch
+            k (int): Number of batches in a bucket
+        Returns:
+            `LengthBucketSampler`: to be passed to DataLoader as `batch_sampler`
+        """
+        return LengthBucketSampler(self.sentence_lengths, batch_size, bucket_factor=k)
+
+    def build_loader(self, batch_size=1, num_workers=4, pin_memory=True):
+        """Create a DataLoader which pads batches with `collate_fn` in worker processes
+
+        Batches with more than one sentence are drawn by a `LengthBucketSampler`,
+        single sentence batches are iterated in the dataset order.
+
+        Arguments:
+            batch_size (int): Number of sentences in a batch
+            num_workers (int): Number of worker processes which prepare batches while the model runs
+            pin_memory (bool): Copy batches into page-locked memory for asynchronous copies to gpu.
+                Should be False if cuda is not available
+        Returns:
+            `torch.utils.data.DataLoader`: data loader
+        """
+        if batch_size > 1:
+            return DataLoader(self, batch_sampler=self.make_length_sampler(batch_size), collate_fn=self.collate_fn,
+                              num_workers=num_workers, pin_memory=pin_memory)
+        return DataLoader(self, collate_fn=self.collate_fn, num_workers=num_workers, pin_memory=pin_memory)
 
     def __len__(self):
-        return len(self.sentences)
+        if self.sentences is not None:
+            return len(self.sentences)
+        return len(self._sentence_offsets) - 1
 
     def __getitem__(self, index):
-        sentence = self.sentences[index]
-        max_token_len = max([len(surface)+1 for surface in sentence.surface_words])
-        max_lemma_len = max([len(lemma)+2 for lemma in sentence.lemmas])
-        max_morph_tags_len = max([len(morph_tag)+2 for morph_tag in sentence.morph_tags])
-
-        # Encode surfaces
-        encoded_surfaces = torch.zeros((len(sentence), max_token_len), dtype=torch.long)
-        for ix, surface in enumerate(sentence.surface_words):
-            encoded_surface = self.encode(surface, self.surface_char2id)
-            encoded_surfaces[ix, :encoded_surface.size()[0]] = encoded_surface
-
-        # Encode lemmas
-        encoded_lemmas = torch.zeros((len(sentence), max_lemma_len), dtype=torch.long)
-        for ix, lemma in enumerate(sentence.lemmas):
-            encoded_lemma = self.encode(lemma, self.lemma_char2id, add_start_tag=True)
-            encoded_lemmas[ix, :encoded_lemma.size()[0]] = encoded_lemma
-
-        # Encode surfaces
-        encoded_morph_tags = torch.zeros((len(sentence), max_morph_tags_len), dtype=torch.long)
-        for ix, morph_tag in enumerate(sentence.morph_tags):
-            encoded_morph_tag = self.encode(morph_tag, self.morph_tag2id, add_start_tag=True)
-            encoded_morph_tags[ix, :encoded_morph_tag.size()[0]] = encoded_morph_tag
-
-        # Encode transformations
-        encoded_transformations = torch.zeros((len(sentence), max_token_len), dtype=torch.long)
-        for ix, transformation in enumerate(sentence.transformations):
-            encoded_transformation = self.encode(transformation, self.transformation2id,
-                                                 add_start_tag=False, add_end_tag=False)
-            encoded_transformations[ix, :encoded_transformation.size()[0]] = encoded_transformation
-
-        return encoded_surfaces, encoded_lemmas, encoded_morph_tags, encoded_transformations
\ No newline at end of file
+        """Get encoded sentence
+
+        Arguments:
+            index (int): index of the sentence
+        Returns:
+            tuple: (encoded_surfaces, encoded_lemmas, encoded_morph_tags, encoded_transformations)
+                each one is a (values, offsets) tuple of numpy arrays where the ids of i-th word are
+                values[offsets[i]:offsets[i+1]]
+        """
+        # Datasets pickled by older versions still hold `Sentence` objects
+        if self.sentences is not None:
+            self._materialize_soa()
+        start, end = self._sentence_offsets[index], self._sentence_offsets[index + 1]
+        return tuple((values[word_offsets[start]:word_offsets[end]], word_offsets[start:end + 1] - word_offsets[start])
+                     for values, word_offsets in self._fields)
+
+    @staticmethod
+    def _smallest_dtype(vocab_size):
+        if vocab_size <= np.iinfo(np.uint8).max + 1:
+            return np.uint8
+        if vocab_size <= np.iinfo(np.int16).max + 1:
+            return np.int16
+        return np.int32
+
+    def _encode_sentences(self):
+        """Encode all sentences in the dataset into flat buffers
+
+        The encoded words of each field are concatenated into one values array for the whole dataset,
+        word boundaries are kept in a word offsets array and sentence boundaries in a sentence offsets array.
+        So a sentence can be sliced out of the buffers without any per word object.
+
+        Characters of surfaces and lemmas are encoded with a codepoint lookup table in a single numpy gather.
+        Morph tags and transformations repeat a lot across a corpus, so each unique sequence is encoded once
+
+        Returns:
+            tuple: (sentence_offsets, fields) where fields is a tuple of (values, word_offsets) arrays of
+                surfaces, lemmas, morph tags and transformations.
+                Words of i-th sentence are the words between sentence_offsets[i] and sentence_offsets[i+1]
+        """
+        encodings = (
+            (self._char_lut(self.surface_char2id), None, self.surface_eos_id),
+            (self._char_lut(self.lemma_char2id), self.lemma_start_id, self.lemma_eos_id),
+            (self.morph_tag2id, self.morph_tag_start_id, self.morph_tag_eos_id),
+            (self.transformation2id, None, None),
+        )
+        chunks = self._map_chunks(_encode_chunk, encodings, self._dtypes)
+
+        # Offsets of each chunk are shifted by the number of words and values of the preceding chunks
+        sentence_offsets = [np.zeros(1, dtype=np.int64)]
+        fields = [([], [np.zeros(1, dtype=np.int64)]) for _ in encodings]
+        for chunk_sentence_offsets, chunk_fields in chunks:
+            sentence_offsets.append(chunk_sentence_offsets[1:] + sentence_offsets[-1][-1])
+            for (values, word_offsets), (chunk_values, chunk_word_offsets) in zip(fields, chunk_fields):
+                word_offsets.append(chunk_word_offsets[1:] + word_offsets[-1][-1])
+                values.append(chunk_values)
+        return np.concatenate(sentence_offsets), tuple(
+            (np.concatenate(values) if values else np.zeros(0, dtype=dtype), np.concatenate(word_offsets))
+            for (values, word_offsets), dtype in zip(fields, self._dtypes))
+
+    def _map_chunks(self, func, *args):
+        """Apply func to chunks of sentences, in worker processes if the dataset is large
+
+        Arguments:
+            func (callable): module level function which takes a list of sentences followed by args
+            *args: additional arguments of func
+        Returns:
+            list: results of func for each chunk in the order of sentences
+        """
+        if len(self.sentences) <= self.PARALLEL_MIN_SENTENCES:
+            return [func(self.sentences, *args)]
+        num_workers = os.cpu_count() or 1
+        chunk_size = -(-len(self.sentences) // (num_workers * 4))
+        chunks = [self.sentences[ix:ix + chunk_size] for ix in range(0, len(self.sentences), chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(func, chunks, *[[arg] * len(chunks) for arg in args]))
+
+    @staticmethod
+    def _char_lut(vocab):
+        """Create a lookup table from codepoints to ids of the single character tokens of vocab
+
+        Unknown characters map to 0, the id of the padding token, including the ones beyond the last codepoint of
+        the table which are clipped to its zero last entry.
+        """
+        chars = [ch for ch in vocab if len(ch) == 1]
+        lut = np.zeros(max(map(ord, chars), default=0) + 2, dtype=np.int32)
+        for ch in chars:
+            lut[ord(ch)] = vocab[ch]
+        return lut
+
+    @staticmethod
+    def _encode_chars(words, lut, start_id=None, end_id=None, dtype=np.int32):
+        """Encode words into flat (values, offsets) arrays with a codepoint lookup table
+
+        Unknown characters are skipped as in `encode`.
+        """
+        if not words:
+            return np.zeros(0, dtype=dtype), np.zeros(1, dtype=np.int64)
+        codepoints = np.frombuffer(''.join(words).encode('utf-32-le'), dtype='<u4')
+        ids = lut[np.minimum(codepoints, len(lut) - 1)]
+        word_ixs = np.repeat(np.arange(len(words)), [len(word) for word in words])
+        known = ids != 0
+        ids, word_ixs = ids[known], word_ixs[known]
+
+        # Number of known characters of each word and the position of each character in its word
+        char_counts = np.bincount(word_ixs, minlength=len(words))
+        positions = np.arange(len(ids)) - (np.cumsum(char_counts) - char_counts)[word_ixs]
+
+        has_start = start_id is not None
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(char_counts + has_start + (end_id is not None), out=offsets[1:])
+        values = np.empty(offsets[-1], dtype=dtype)
+        if has_start:
+            values[offsets[:-1]] = start_id
+        if end_id is not None:
+            values[offsets[1:] - 1] = end_id
+        values[offsets[word_ixs] + has_start + positions] = ids
+        return values, offsets
+
+    @staticmethod
+    def _encode_flat(seqs, vocab, start_id=None, end_id=None, dtype=np.int32):
+        """Encode sequences into flat (values, offsets) arrays
+
+        Sequences repeat a lot across a corpus, so each unique sequence is encoded once
+        and the encodings are gathered into the flat arrays with numpy indexing.
+        """
+        # Index of each sequence in the unique sequences, lists are converted to tuples to be used as keys
+        unique = dict()
+        unique_seqs = []
+        seq_ixs = array('l')
+        for seq in seqs:
+            key = tuple(seq)
+            ix = unique.get(key)
+            if ix is None:
+                ix = unique[key] = len(unique_seqs)
+                unique_seqs.append(key)
+            seq_ixs.append(ix)
+
+        unique_values = array('l')
+        unique_offsets = array('l', [0])
+        for seq in unique_seqs:
+            unique_values.extend(ConllDataset.encode(seq, vocab, start_id=start_id, end_id=end_id))
+            unique_offsets.append(len(unique_values))
+        unique_values = np.array(unique_values, dtype=dtype)
+        unique_offsets = np.array(unique_offsets, dtype=np.int64)
+
+        seq_ixs = np.array(seq_ixs, dtype=np.int64)
+        lengths = np.diff(unique_offsets)[seq_ixs]
+        offsets = np.zeros(len(seq_ixs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of each value in the unique values
+        positions = np.arange(offsets[-1]) + np.repeat(unique_offsets[:-1][seq_ixs] - offsets[:-1], lengths)
+        return unique_values[positions], offsets
+
+    @staticmethod
+    def collate_fn(batch):
+        """Pad a batch of encoded sentences into one tensor per field
+
+        Sentences are padded to the maximum number of words in the batch and
+        the sequences of each field are padded to the maximum sequence length of the field in the batch.
+        Transformations are padded to the same length as surfaces since they are predicted per surface character.
+
+        Tensors keep the small integer types of the dataset to make host to device copies cheaper,
+        they should be cast with `.long()` after they are moved to the device.
+
+        Arguments:
+            batch (list): list of (surfaces, lemmas, morph_tags, transformations) tuples returned by `__getitem__`
+        Returns:
+            tuple: (encoded_surfaces, encoded_lemmas, encoded_morph_tags, encoded_transformations)
+                tensors of shape (batch size, maximum number of words, maximum sequence length)
+        """
+        word_counts = [len(sample[0][1]) - 1 for sample in batch]
+        # Batch and word index of each word in the batch
+        sample_ixs = np.repeat(np.arange(len(batch)), word_counts)
+        word_ixs = np.concatenate([np.arange(word_count) for word_count in word_counts])
+
+        fields = []
+        for field in range(4):
+            values = np.concatenate([sample[field][0] for sample in batch])
+            lengths = np.concatenate([np.diff(sample[field][1]) for sample in batch])
+            fields.append((values, lengths))
+        max_lens = [int(lengths.max()) if len(lengths) else 0 for _, lengths in fields]
+        max_lens[0] = max_lens[3] = max(max_lens[0], max_lens[3])
+
+        padded_fields = []
+        for (values, lengths), max_len in zip(fields, max_lens):
+            padded = np.zeros((len(batch), max(word_counts), max_len), dtype=values.dtype)
+            # Position of each value in its word, all values of the field are written with a single assignment
+            starts = np.cumsum(lengths) - lengths
+            positions = np.arange(len(values)) - np.repeat(starts, lengths)
+            padded[np.repeat(sample_ixs, lengths), np.repeat(word_ixs, lengths), positions] = values
+            # torch.from_numpy shares the buffer, no copy is made
+            padded_fields.append(torch.from_numpy(padded))
+        return tuple(padded_fields)
+
+
+# Vocabs of a train dataset, which are all that prediction needs from it
+Vocab = namedtuple('Vocab', ['surface_char2id', 'lemma_char2id', 'transformation2id', 'morph_tag2id',
+                             'surface_eos_id'])
+
+
+def save_vocab(dataset, path):
+    """Save the vocabs of a dataset, they are much smaller and faster to load than the pickled dataset
+
+    Arguments:
+        dataset (`ConllDataset`): train dataset
+        path (str): output file path
+    """
+    torch.save({field: getattr(dataset, field) for field in Vocab._fields}, path)
+
+
+def load_vocab(path):
+    """Load vocabs saved by `save_vocab`
+
+    Arguments:
+        path (str): vocab file path
+    Returns:
+        `Vocab`: vocabs of the train dataset
+    """
+    return Vocab(**torch.load(path))
+
+
+def _collect_symbols(sentences):
+    """Collect surface chars, lemma chars, morph tags and transformations (in order of occurrence) of sentences"""
+    surface_chars = set()
+    lemma_chars = set()
+    tags = set()
+    transformations = dict()
+    for sentence in sentences:
+        for surface in sentence.surface_words:
+            surface_chars.update(surface)
+        for lemma in sentence.lemmas:
+            lemma_chars.update(lemma)
+        for morph_tag in sentence.morph_tags:
+            tags.update(morph_tag)
+        for transformation in sentence.transformations:
+            for _t in transformation:
+                transformations.setdefault(_t, len(transformations))
+    return surface_chars, lemma_chars, tags, sorted(transformations, key=transformations.get)
+
+
+def _encode_chunk(sentences, encodings, dtypes):
+    """Encode sentences into (sentence_offsets, fields) flat arrays, see `ConllDataset._encode_sentences`"""
+    sentence_offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    np.cumsum([len(sentence) for sentence in sentences], out=sentence_offsets[1:])
+
+    words = (
+        [surface for sentence in sentences for surface in sentence.surface_words],
+        [lemma for sentence in sentences for lemma in sentence.lemmas],
+    )
+    seqs = (
+        chain.from_iterable(sentence.morph_tags for sentence in sentences),
+        # Right to left sentences have no transformations, they get an empty transformation per word
+        chain.from_iterable(sentence.transformations or [()] * len(sentence) for sentence in sentences),
+    )
+    return sentence_offsets, tuple(
+        [ConllDataset._encode_chars(_words, lut, start_id=start_id, end_id=end_id, dtype=dtype)
+         for _words, (lut, start_id, end_id), dtype in zip(words, encodings[:2], dtypes[:2])] +
+        [ConllDataset._encode_flat(_seqs, vocab, start_id=start_id, end_id=end_id, dtype=dtype)
+         for _seqs, (vocab, start_id, end_id), dtype in zip(seqs, encodings[2:], dtypes[2:])])
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler which groups sentences with similar lengths to reduce padding
+
+    Sentence indices are sorted by their lengths and split into buckets of `batch_size * bucket_factor` sentences.
+    Each bucket is shuffled and chunked into batches, then the order of all batches is shuffled.
+
+    """
+
+    def __init__(self, lengths, batch_size, bucket_factor=50):
+        """Initialize LengthBucketSampler.
+
+        Arguments:
+            lengths (list): Sort keys of sentences, e.g. (number of words, maximum word length) tuples
+            batch_size (int): Number of sentences in a batch
+            bucket_factor (int): Number of batches in a bucket
+        """
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_factor
+
+    def __iter__(self):
+        sorted_indices = sorted(range(len(self.lengths)), key=self.lengths.__getitem__)
+        batches = []
+        for start in range(0, len(sorted_indices), self.bucket_size):
+            bucket = sorted_indices[start:start + self.bucket_size]
+            bucket = [bucket[ix] for ix in torch.randperm(len(bucket)).tolist()]
+            batches.extend(bucket[ix:ix + self.batch_size] for ix in range(0, len(bucket), self.batch_size))
+        for ix in torch.randperm(len(batches)).tolist():
+            yield batches[ix]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def test_mmap_cache():
+    import shutil
+    import tempfile
+
+    conll_file_path = '../data/2019/task2/UD_English-GUM/en_gum-um-dev.conllu'
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # The cache is written next to the conll file, so a copy of it is used
+        data_path = os.path.join(temp_dir, os.path.basename(conll_file_path))
+        shutil.copy(conll_file_path, data_path)
+
+        for surface_char2id in (None, {'<p>': 0, '<e>': 1, 'a': 2}):
+            vocabs = []
+            datasets = []
+            # The first load writes the cache and the second one memory maps it
+            for _ in range(2):
+                given_vocab = dict(surface_char2id) if surface_char2id else None
+                dataset = ConllDataset(data_path, surface_char2id=given_vocab, max_sentences=5, mmap=True)
+                if given_vocab is not None:
+                    assert given_vocab == dataset.surface_char2id, 'Given vocab is not updated'
+                vocabs.append((dataset.surface_char2id, dataset.lemma_char2id, dataset.morph_tag2id,
+                               dataset.transformation2id))
+                datasets.append(dataset)
+            cold, warm = datasets
+            assert isinstance(warm._fields[0][0], np.memmap), 'Cache is not loaded'
+            assert vocabs[0] == vocabs[1], 'Vocabs of the cached dataset are different'
+            assert len(cold) == len(warm)
+            for ix in range(len(cold)):
+                for (cold_values, cold_offsets), (warm_values, warm_offsets) in zip(cold[ix], warm[ix]):
+                    assert np.array_equal(cold_values, warm_values) and np.array_equal(cold_offsets, warm_offsets)
+            max_surface_id = max(int(warm[ix][0][0].max()) for ix in range(len(warm)))
+            assert max_surface_id < len(warm.surface_char2id), 'Encoded ids are out of the vocab'
+
+        # A memory mapped dataset is not affected by loads with other arguments or by rewrites of its cache
+        ConllDataset(data_path, mmap=True)
+        mapped = ConllDataset(data_path, mmap=True)
+        assert isinstance(mapped._fields[0][0], np.memmap), 'Cache is not loaded'
+        expected = [[(np.array(values), np.array(offsets)) for values, offsets in mapped[ix]]
+                    for ix in range(len(mapped))]
+        ConllDataset(data_path, max_sentences=5, mmap=True)
+        for cache_key in os.listdir(data_path + '.cache'):
+            os.remove(os.path.join(data_path + '.cache', cache_key, 'meta.pkl'))
+        ConllDataset(data_path, mmap=True)
+        for ix in range(len(mapped)):
+            for (values, offsets), (expected_values, expected_offsets) in zip(mapped[ix], expected[ix]):
+                assert np.array_equal(values, expected_values) and np.array_equal(offsets, expected_offsets), \
+                    'Memory mapped dataset is changed by another load'
+        print('Cached dataset is the same as the dataset read from the conll file')
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    test_mmap_cache()
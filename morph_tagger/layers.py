@@ -1,8 +1,13 @@
+import heapq
+import math
 from collections import namedtuple
-from operator import attrgetter
+from operator import attrgetter, itemgetter
 
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from tqdm import tqdm
 
 from data_utils import inverse_transformation
@@ -43,53 +48,156 @@ class EncoderRNN(nn.Module):
         self.word_gru = nn.GRU(hidden_size1, hidden_size2, bidirectional=True, num_layers=1, batch_first=True)
         self.dropout = nn.Dropout(dropout_ratio)
 
-        # Initialize hidden units
-        self.char_gru_hidden = None
-        self.word_gru_hidden = None
-
         self.device = device
 
-    def init_context_hidden(self):
-        """Initializes the hidden units of each context gru
-
-        """
-        return torch.zeros(2, 1, self.hidden_size2).to(self.device)
-
-    def init_char_hidden(self, batch_size):
-        """Initializes the hidden units of each char gru
-
-        """
-        return torch.zeros(1, batch_size, self.hidden_size1).to(self.device)
-
     def forward(self, x):
         """Forward pass of EncoderRNN
 
         Embedding layer, first level grus and second level grus are applied to input  tensor
         Dropouts are applied between all layers with parameters
 
+        Sentences of a batch are padded with words without characters, which are left out of the outputs.
+
+        Args:
+            x (`torch.tensor`): encoded characters of shape (number of sentences, maximum number of words,
+                maximum word length)
+
         Returns:
             torch.Tensor: word embeddings generated by first-level character grus
             torch.Tensor: context-aware representations of the words occur in the sentence
+                Words of all sentences in the batch are concatenated in order
 
         """
-        # Batch size should be 1, sentences are batche in our implementation
-        assert x.size(0) == 1, "Batch size should be 1 since each sentence is considered as a mini-batch"
-
-        self.char_gru_hidden = self.init_char_hidden(x.size(1))
-        self.word_gru_hidden = self.init_context_hidden()
+        # Every word has at least the end of word character, padding words have none
+        mask = x[:, :, 0] != 0
+        word_counts = mask.sum(1)
 
         # Embedding layer
-        char_embeddings = self.embedding(x)
+        char_embeddings = self.embedding(x[mask])
         char_embeddings = self.dropout(char_embeddings)
 
         # First-level gru layer (char-gru to generate word embeddings)
-        _, word_embeddings = self.char_gru(char_embeddings.view(char_embeddings.shape[1:]), self.char_gru_hidden)
+        # Hidden units of both grus are not given, so gru initializes them with zeros on the device of the input
+        _, word_embeddings = self.char_gru(char_embeddings)
         word_embeddings = self.dropout(word_embeddings)
 
         # Second-level gru layer (context-gru)
-        context_embeddings = self.word_gru(word_embeddings, self.word_gru_hidden)[0]
+        if x.size(0) == 1:
+            context_embeddings = self.word_gru(word_embeddings)[0][0]
+        else:
+            context_embeddings = self._packed_word_gru(word_embeddings[0], mask, word_counts)
         context_embeddings = self.dropout(context_embeddings)
-        return word_embeddings[0], context_embeddings[0]
+        return word_embeddings[0], context_embeddings
+
+    def _packed_word_gru(self, word_embeddings, mask, word_counts):
+        # Words are placed back into their sentences and the sentences are packed to exclude padding words
+        padded = word_embeddings.new_zeros((mask.size(0), mask.size(1), word_embeddings.size(1)))
+        padded[mask] = word_embeddings
+        # Packed sequences should be sorted by length in decreasing order
+        word_counts, order = word_counts.sort(descending=True)
+        packed = pack_padded_sequence(padded[order], word_counts.tolist(), batch_first=True)
+        context_embeddings, _ = pad_packed_sequence(self.word_gru(packed)[0], batch_first=True,
+                                                    total_length=mask.size(1))
+        context_embeddings = context_embeddings.new_empty(context_embeddings.size()).index_copy_(
+            0, order, context_embeddings)
+        return context_embeddings[mask]
+
+
+class MinGRU(nn.Module):
+    """A minimal GRU (minGRU) which can be used in place of `nn.GRU` in decoders
+
+    The update gate and the candidate hidden state of minGRU depend only on the inputs:
+        z_t = sigmoid(W_z x_t), h'_t = W_h x_t, h_t = (1 - z_t) * h_{t-1} + z_t * h'_t
+    So the hidden states are computed in parallel within chunks of time steps from cumulative sums of
+    log(1 - z_t) instead of stepping through the sequence. A single step with a given hidden state is the same
+    recurrence, so step by step prediction works as with `nn.GRU`.
+
+    """
+
+    def __init__(self, input_size, hidden_size, num_layers=1, batch_first=True, bidirectional=False):
+        """Initialize a MinGRU object
+
+        Args:
+            input_size (int): The dimension of the inputs
+            hidden_size (int): The number of units
+            num_layers (int): Number of stacked layers
+            batch_first (bool): Only batch first inputs are supported, kept for `nn.GRU` compatibility
+            bidirectional (bool): If True, each layer is run in both directions and the outputs are concatenated
+        """
+        super(MinGRU, self).__init__()
+        assert batch_first, "MinGRU supports batch first inputs only"
+
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.num_directions = 2 if bidirectional else 1
+
+        # A single linear layer computes the update gate and the candidate hidden state of each layer and direction
+        self.linears = nn.ModuleList([
+            nn.Linear(input_size if layer == 0 else hidden_size * self.num_directions, 2 * hidden_size)
+            for layer in range(num_layers) for _ in range(self.num_directions)
+        ])
+
+    def forward(self, x, hidden=None):
+        """Forward pass of MinGRU
+
+        Args:
+            x (`torch.tensor`): inputs of shape (batch size, sequence length, input size)
+            hidden (`torch.tensor`): initial hidden states of shape (num_layers * num_directions, batch size, hidden size)
+                Default is None which means zeros.
+
+        Returns:
+            tuple: (outputs of the last layer for each time step, hidden states of the last time step)
+        """
+        if hidden is None:
+            hidden = x.new_zeros((self.num_layers * self.num_directions, x.size(0), self.hidden_size))
+
+        outputs = x
+        last_hiddens = []
+        for layer in range(self.num_layers):
+            direction_outputs = []
+            for direction in range(self.num_directions):
+                ix = layer * self.num_directions + direction
+                # Backward direction runs on the reversed sequence
+                inputs = outputs if direction == 0 else outputs.flip(1)
+                hiddens = self._parallel_scan(self.linears[ix](inputs), hidden[ix])
+                last_hiddens.append(hiddens[:, -1])
+                direction_outputs.append(hiddens if direction == 0 else hiddens.flip(1))
+            outputs = torch.cat(direction_outputs, 2)
+        return outputs, torch.stack(last_hiddens)
+
+    # Steps per chunk of the parallel scan, memory grows linearly with the sequence length and with the chunk size
+    scan_chunk_size = 16
+
+    @classmethod
+    def _parallel_scan(cls, gates, hidden):
+        # Hidden state at step t is: decay(s, t) * h_s + sum over s < k <= t of decay(k, t) * z_k * h'_k
+        # where decay(k, t) is the product of (1 - z_j) for k < j <= t, computed in log space.
+        # The sequence is split into chunks, within a chunk the sum is computed in parallel and
+        # the hidden state of the last step of a chunk is carried to the next one.
+        batch_size, seq_len, hidden_size = gates.size(0), gates.size(1), gates.size(2) // 2
+        chunk_size = min(cls.scan_chunk_size, seq_len)
+        num_chunks = (seq_len + chunk_size - 1) // chunk_size
+        padding = num_chunks * chunk_size - seq_len
+        if padding:
+            # Padded steps come after the real ones so they do not change the outputs
+            gates = torch.cat([gates, gates.new_zeros((batch_size, padding, gates.size(2)))], 1)
+        gates = gates.view(batch_size, num_chunks, chunk_size, 2 * hidden_size)
+        update_gates, candidates = gates.chunk(2, 3)
+        # log(1 - sigmoid(u)) = -softplus(u)
+        log_decays = -F.softplus(update_gates).cumsum(2)
+        mask = gates.new_ones((chunk_size, chunk_size)).tril().view(1, 1, chunk_size, chunk_size, 1)
+        # Decays above the diagonal are masked, they are clamped to avoid overflows in exp
+        decays = (log_decays.unsqueeze(3) - log_decays.unsqueeze(2)).clamp(max=0).exp() * mask
+        inputs = torch.sigmoid(update_gates) * candidates
+        chunk_hiddens = (decays * inputs.unsqueeze(2)).sum(3)
+        chunk_decays = log_decays.exp()
+
+        outputs = []
+        for chunk in range(num_chunks):
+            hiddens = chunk_hiddens[:, chunk] + chunk_decays[:, chunk] * hidden.unsqueeze(1)
+            hidden = hiddens[:, -1]
+            outputs.append(hiddens)
+        return torch.cat(outputs, 1)[:, :seq_len]
 
 
 class DecoderRNN(nn.Module):
@@ -100,7 +208,7 @@ class DecoderRNN(nn.Module):
 
     """
 
-    def __init__(self, embedding_size, hidden_size, vocab, dropout_ratio=0):
+    def __init__(self, embedding_size, hidden_size, vocab, dropout_ratio=0, use_min_gru=False):
         """Initialize the decoder object
 
         Args:
@@ -109,6 +217,7 @@ class DecoderRNN(nn.Module):
             hidden_size (int): The number of units in gru
             vocab (dict): Vocab dictionary where keys are either characters or tags and the values are integer
             dropout_ratio(float): Dropout ratio, dropout applied to the outputs of both gru and embedding modules
+            use_min_gru (bool): Use `MinGRU` instead of `nn.GRU`. Default is False
         """
         super(DecoderRNN, self).__init__()
 
@@ -117,17 +226,18 @@ class DecoderRNN(nn.Module):
 
         # Vocab and inverse vocab to converts output indexes to characters and tags
         self.vocab = vocab
-        self.index2token = {v: k for k, v in vocab.items()}
+        # Ids are dense, so the inverse vocab is a tuple of tokens indexed by their ids
+        self.id2token = tuple(token for token, _ in sorted(vocab.items(), key=itemgetter(1)))
         self.vocab_size = len(vocab)
 
         # Layers
         self.W = nn.Linear(2 * hidden_size, hidden_size)
         self.embedding = nn.Embedding(len(vocab)+1, embedding_size)
-        self.gru = nn.GRU(embedding_size, hidden_size, 2, batch_first=True)
+        self.gru = (MinGRU if use_min_gru else nn.GRU)(embedding_size, hidden_size, 2, batch_first=True)
         self.classifier = nn.Linear(hidden_size, len(vocab))
         self.dropout = nn.Dropout(p=dropout_ratio)
-        self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)
+        # Applied in place on the fresh outputs of W, saves an allocation per forward pass
+        self.relu = nn.ReLU(inplace=True)
 
     def forward(self, word_embeddings, context_vectors, y):
         """Forward pass of DecoderRNN
@@ -145,8 +255,7 @@ class DecoderRNN(nn.Module):
 
         # Initilize gru hidden units with context vector (encoder output)
         context_vectors = self.relu(self.W(context_vectors))
-        hidden = torch.cat([context_vectors.view(1, *context_vectors.size()),
-                            word_embeddings.view(1, *context_vectors.size())], 0)
+        hidden = torch.stack([context_vectors, word_embeddings])
 
         embeddings = self.embedding(y)
         embeddings = self.dropout(embeddings)
@@ -162,6 +271,10 @@ class DecoderRNN(nn.Module):
         The loop for gru is stopped as soon as the end of sentence tag is produced twice.
         The first end of sentence tag indicates the end of the root while the second one indicates the end of tags
 
+        Predicted tokens are kept on the device of the inputs and the end of sentence tag is checked
+        every `sync_interval` steps on gpu since each check waits for the gpu.
+        The steps after the end of sentence tag are discarded and their scores are left as zeros.
+
         Args:
             word_embedding (`torch.tensor`): word representation (outputs of char GRU
             context_vector (`torch.tensor`): Context-aware representation of a word
@@ -172,36 +285,96 @@ class DecoderRNN(nn.Module):
             tuple: (scores:`torch.tensor`, predictions:list)
 
         """
+        sync_interval = 8 if context_vector.is_cuda else 1
+
+        with torch.no_grad():
+            # Initilize gru hidden units with context vector (encoder output)
+            context_vector = context_vector.unsqueeze(0)
+            context_vector = self.relu(self.W(context_vector))
+            hidden = torch.stack([context_vector, word_embedding.unsqueeze(0)])
+
+            # Oupput shape (maximum length of a an analyzer, output vocab size)
+            scores = context_vector.new_zeros((max_len, self.vocab_size))
+            tokens = context_vector.new_zeros(max_len, dtype=torch.long)
+
+            # First predicted token is sentence start tag: 2
+            predicted_token = context_vector.new_full((1,), 2, dtype=torch.long)
+
+            # Generate char or tag sequentially
+            num_steps = 0
+            while num_steps < max_len:
+                # Embedding has no padding index, so rows of its weight are looked up directly
+                embedded = self.embedding.weight[predicted_token].unsqueeze(0)
+                output, hidden = self.gru(embedded, hidden)
+                output = self.classifier(output[0])
+                scores[num_steps] = output[0]
+                topv, topi = output.topk(1)
+                predicted_token = topi.view(1)
+                tokens[num_steps] = predicted_token[0]
+                num_steps += 1
+                # Stop if eos is produced in the last sync_interval steps
+                if num_steps % sync_interval == 0 and (tokens[num_steps - sync_interval:num_steps] == 1).any():
+                    break
+
+        # Tokens are copied to the host once, the prediction ends at the first eos
+        tokens = tokens[:num_steps].tolist()
+        if 1 in tokens:
+            tokens = tokens[:tokens.index(1)]
+            scores[len(tokens) + 1:] = 0
+        # Add predicted outputs to predictions if they are not special characters such as eos or padding
+        predictions = [self.id2token[token] for token in tokens if token > 2]
 
-        # Initilize gru hidden units with context vector (encoder output)
-        context_vector = context_vector.view(1, *context_vector.size())
-        context_vector = self.relu(self.W(context_vector).view(1, 1, self.hidden_size))
-        word_embedding = word_embedding.view(1, 1, self.hidden_size)
-        hidden = torch.cat([context_vector, word_embedding], 0)
+        return scores, predictions
 
-        # Oupput shape (maximum length of a an analyzer, output vocab size)
-        scores = torch.zeros(max_len, self.vocab_size)
+    def predict_batch(self, word_embeddings, context_vectors, max_len=50):
+        """Greedy prediction of many words at once
 
-        # First predicted token is sentence start tag: 2
-        predicted_token = torch.LongTensor(1).fill_(2).to(device)
+        All words are decoded in lockstep, so each step is one gru call for the whole batch. The loop stops as soon as
+        every word has produced the end of sentence tag, which is checked every `sync_interval` steps on gpu.
+        The steps after the end of sentence tag of a word are discarded.
 
-        # Generate char or tag sequentially
-        predictions = []
-        for di in range(max_len):
-            embedded = self.embedding(predicted_token).view(1, 1, -1)
-            output, hidden = self.gru(embedded, hidden)
-            output = self.classifier(output[0])
-            scores[di] = output
-            topv, topi = output.topk(1)
-            predicted_token = topi.squeeze().detach().to(device)
-            # Increase eos count if produced output is eos
-            if predicted_token.item() == 1:
-                break
-            # Add predicted output to predictions if it is not a special character such as eos or padding
-            if predicted_token.item() > 2:
-                predictions.append(self.index2token[predicted_token.item()])
+        Args:
+            word_embeddings (`torch.tensor`): word representations (outputs of char GRU), shape (words, hidden size)
+            context_vectors (`torch.tensor`): Context-aware representations of the words
+            max_len (int): Maximum length of produced analyses (Defaault: 50)
 
-        return scores, predictions
+        Returns:
+            list: predictions (list of tokens) of each word
+
+        """
+        sync_interval = 8 if context_vectors.is_cuda else 1
+
+        with torch.no_grad():
+            # Initilize gru hidden units with context vectors (encoder outputs)
+            context_vectors = self.relu(self.W(context_vectors))
+            hidden = torch.stack([context_vectors, word_embeddings])
+
+            # Oupput shape (maximum length of a an analyzer, number of words)
+            tokens = context_vectors.new_zeros((max_len, context_vectors.size(0)), dtype=torch.long)
+
+            # First predicted token is sentence start tag: 2
+            predicted_tokens = context_vectors.new_full((context_vectors.size(0),), 2, dtype=torch.long)
+            finished = predicted_tokens == 1
+
+            num_steps = 0
+            while num_steps < max_len:
+                embedded = self.embedding.weight[predicted_tokens].unsqueeze(1)
+                output, hidden = self.gru(embedded, hidden)
+                output = self.classifier(output[:, 0])
+                predicted_tokens = output.topk(1)[1].view(-1)
+                tokens[num_steps] = predicted_tokens
+                finished |= predicted_tokens == 1
+                num_steps += 1
+                if num_steps % sync_interval == 0 and finished.all():
+                    break
+
+        # Tokens are copied to the host once, each prediction ends at its first eos
+        predictions = []
+        for word_tokens in tokens[:num_steps].t().tolist():
+            if 1 in word_tokens:
+                word_tokens = word_tokens[:word_tokens.index(1)]
+            predictions.append([self.id2token[token] for token in word_tokens if token > 2])
+        return predictions
 
     def predict_beam(self, word_embedding, context_vector, surface_len, beam_size=2, max_len=50, device=torch.device('cpu')):
         """Forward pass of DecoderRNN using beam search for prediction only
@@ -209,6 +382,11 @@ class DecoderRNN(nn.Module):
         The loop for gru is stopped as soon as the end of sentence tag is produced twice.
         The first end of sentence tag indicates the end of the root while the second one indicates the end of tags
 
+        All states of the beam are decoded as a batch, so each step runs the gru once and copies the
+        top candidates to the host once.
+        Scores are log probabilities, products of probabilities and the length normalization are applied as sums
+        in log space which gives the same ranking without underflows for long predictions.
+
         Args:
             word_embedding (`torch.tensor`): word representation (outputs of char GRU
             context_vector (`torch.tensor`): Context-aware representation of a word
@@ -220,49 +398,51 @@ class DecoderRNN(nn.Module):
 
         """
 
-        State = namedtuple('State', ['prediction', 'score', 'normalized_score', 'last_output', 'hidden'])
+        # parent is the index of the hidden state of the state in the previous step
+        State = namedtuple('State', ['prediction', 'score', 'normalized_score', 'last_output', 'parent'])
 
-        # Initilize gru hidden units with context vector (encoder output)
-        context_vector = context_vector.view(1, *context_vector.size())
-        context_vector = self.relu(self.W(context_vector).view(1, 1, self.hidden_size))
-        word_embedding = word_embedding.view(1, 1, self.hidden_size)
-        hidden = torch.cat([context_vector, word_embedding], 0)
+        with torch.no_grad():
+            # Initilize gru hidden units with context vector (encoder output)
+            context_vector = context_vector.unsqueeze(0)
+            context_vector = self.relu(self.W(context_vector))
+            hidden = torch.stack([context_vector, word_embedding.unsqueeze(0)])
 
-        states = [State('', 1.0, 1.0, torch.LongTensor(1).fill_(2).to(device), hidden)]
-        completed_states = []
+            states = [State('', 0.0, 0.0, 2, 0)]
+            completed_states = []
 
-        while states:
-            new_states = []
             while states:
-                state = states.pop(0)
-                if len(state.prediction) >= surface_len+2:
-                    continue
-                embedded = self.embedding(state.last_output).view(1, 1, -1)
-                gru_outputs, _hidden = self.gru(embedded, state.hidden)
-                scores = self.classifier(gru_outputs[0])
-                scores = self.softmax(scores)
+                states = [state for state in states if len(state.prediction) < surface_len+2]
+                if not states:
+                    break
+                hidden = hidden[:, [state.parent for state in states]]
+                last_outputs = context_vector.new_tensor([state.last_output for state in states], dtype=torch.long)
+                embedded = self.embedding.weight[last_outputs].unsqueeze(1)
+                gru_outputs, hidden = self.gru(embedded, hidden)
+                scores = F.log_softmax(self.classifier(gru_outputs[:, 0]), dim=1)
                 scores, indices = scores.topk(beam_size)
-                for ix, score in zip(indices[0], scores[0]):
-                    predicted_token = ix.squeeze().detach().to(device)
-                    _score = state.score * score
+                scores = scores + context_vector.new_tensor([state.score for state in states]).unsqueeze(1)
 
-                    if predicted_token.item() == 1:
-                        _prediction = state.prediction
-                        prediction_len = len(_prediction) + 1.0
-                        _normalized_score = (_score / ((5.0 + prediction_len) / 6.0)) * (surface_len / prediction_len)
-                    else:
-                        _prediction = state.prediction + self.index2token[predicted_token.item()]
-                        _normalized_score = _score / ((5.0 + len(_prediction)) / 6.0)
+                new_states = []
+                for parent, (state, _scores, _indices) in enumerate(zip(states, scores.tolist(), indices.tolist())):
+                    for _score, predicted_token in zip(_scores, _indices):
+                        if predicted_token == 1:
+                            _prediction = state.prediction
+                            prediction_len = len(_prediction) + 1.0
+                            _normalized_score = _score - math.log((5.0 + prediction_len) / 6.0) + \
+                                math.log(surface_len / prediction_len)
+                        else:
+                            _prediction = state.prediction + self.id2token[predicted_token]
+                            _normalized_score = _score - math.log((5.0 + len(_prediction)) / 6.0)
 
-                    new_state = State(_prediction, _score, _normalized_score, predicted_token, _hidden)
+                        new_state = State(_prediction, _score, _normalized_score, predicted_token, parent)
 
-                    if predicted_token.item() == 1:
-                        completed_states.append(new_state)
-                    else:
-                        new_states.append(new_state)
+                        if predicted_token == 1:
+                            completed_states.append(new_state)
+                        else:
+                            new_states.append(new_state)
 
-            states = sorted(new_states, key=attrgetter('normalized_score'), reverse=True)[:beam_size]
-        return sorted(completed_states, key=attrgetter('normalized_score'), reverse=True)[0].prediction
+                states = heapq.nlargest(beam_size, new_states, key=attrgetter('normalized_score'))
+        return max(completed_states, key=attrgetter('normalized_score')).prediction
 
 
 class TransformerRNN(nn.Module):
@@ -273,7 +453,7 @@ class TransformerRNN(nn.Module):
 
     """
 
-    def __init__(self, embedding_size, hidden_size, vocab, input_vocab_size, dropout_ratio=0):
+    def __init__(self, embedding_size, hidden_size, vocab, input_vocab_size, dropout_ratio=0, use_min_gru=False):
         """Initialize the decoder object
 
         Args:
@@ -282,6 +462,7 @@ class TransformerRNN(nn.Module):
             hidden_size (int): The number of units in gru
             vocab (dict): Vocab dictionary where keys are either characters or tags and the values are integer
             dropout_ratio(float): Dropout ratio, dropout applied to the outputs of both gru and embedding modules
+            use_min_gru (bool): Use `MinGRU` instead of `nn.GRU`. Default is False
         """
         super(TransformerRNN, self).__init__()
 
@@ -290,18 +471,30 @@ class TransformerRNN(nn.Module):
 
         # Vocab and inverse vocab to converts output indexes to characters and tags
         self.vocab = vocab
-        self.index2transformation = {v: k for k, v in vocab.items()}
+        # Object array of transformations indexed by their ids,
+        # predicted ids of all words are looked up with a single numpy indexing
+        self.id2transformation = np.empty(len(vocab), dtype=object)
+        self.id2transformation[:] = [transformation for transformation, _ in sorted(vocab.items(), key=itemgetter(1))]
         self.vocab_size = len(vocab)
         self.input_vocab_size = input_vocab_size
 
         # Layers
         self.W = nn.Linear(2 * hidden_size, hidden_size)
         self.embedding = nn.Embedding(self.input_vocab_size+1, embedding_size)
-        self.gru = nn.GRU(embedding_size, hidden_size, 2, batch_first=True, bidirectional=True)
+        self.gru = (MinGRU if use_min_gru else nn.GRU)(embedding_size, hidden_size, 2, batch_first=True,
+                                                       bidirectional=True)
         self.classifier = nn.Linear(2 * hidden_size, len(vocab))
         self.dropout = nn.Dropout(p=dropout_ratio)
-        self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=2)
+        # Applied in place on the fresh outputs of W, saves an allocation per forward pass
+        self.relu = nn.ReLU(inplace=True)
+
+    @staticmethod
+    def _init_hidden(context_vectors, word_embeddings):
+        # Both directions of the first layer start from the context vectors and the second layer from the word
+        # embeddings, the duplicates are materialized by a single expand and reshape
+        num_words, hidden_size = context_vectors.size()
+        return torch.stack([context_vectors, word_embeddings]).unsqueeze(1).expand(
+            2, 2, num_words, hidden_size).reshape(4, num_words, hidden_size)
 
     def forward(self, word_embeddings, context_vectors, x):
         """Forward pass of DecoderRNN
@@ -319,12 +512,9 @@ class TransformerRNN(nn.Module):
 
         # Initilize gru hidden units with context vector (encoder output)
         context_vectors = self.relu(self.W(context_vectors))
-        hidden = torch.cat([context_vectors.view(1, *context_vectors.size()),
-                            context_vectors.view(1, *context_vectors.size()),
-                            word_embeddings.view(1, *context_vectors.size()),
-                            word_embeddings.view(1, *context_vectors.size())], 0)
+        hidden = self._init_hidden(context_vectors, word_embeddings)
 
-        embeddings = self.embedding(x.view(*x.shape[1:]))
+        embeddings = self.embedding(x.squeeze(0))
         embeddings = self.dropout(embeddings)
         outputs, _ = self.gru(embeddings, hidden)
         outputs = self.dropout(outputs)
@@ -346,38 +536,55 @@ class TransformerRNN(nn.Module):
 
         Returns:
             tuple: (scores:`torch.tensor`, predictions:list)
+                scores are unnormalized, softmax does not change the predicted transformations
 
         """
 
         # Initilize gru hidden units with context vector (encoder output)
         context_vectors = self.relu(self.W(context_vectors))
-        hidden = torch.cat([context_vectors.view(1, *context_vectors.size()),
-                            context_vectors.view(1, *context_vectors.size()),
-                            word_embeddings.view(1, *context_vectors.size()),
-                            word_embeddings.view(1, *context_vectors.size())], 0)
+        hidden = self._init_hidden(context_vectors, word_embeddings)
 
-        embeddings = self.embedding(x.view(*x.shape[1:]))
+        embeddings = self.embedding(x.squeeze(0))
         embeddings = self.dropout(embeddings)
         outputs, _ = self.gru(embeddings, hidden)
         outputs = self.dropout(outputs)
         outputs = self.classifier(outputs)
 
         # Output shape (maximum length of a transformation, output size)
-        scores = self.softmax(outputs).to('cpu')
-        predictions = [[self.index2transformation[ix.item()] for ix in _scores] for _scores in torch.argmax(scores, 2)]
+        # Only the predicted ids are copied to the host
+        predictions = self.id2transformation[torch.argmax(outputs, 2).cpu().numpy()].tolist()
         predictions = [inverse_transformation(surface, prediction[:len(surface)])
                        for surface, prediction in zip(surfaces, predictions)]
-        return scores, predictions
+        return outputs, predictions
+
+
+def test_min_gru():
+    """Checks that the parallel scan of MinGRU gives the hidden states of the sequential recurrence"""
+    torch.manual_seed(0)
+    min_gru = MinGRU(8, 6, num_layers=1)
+    for seq_len in (1, 5, 16, 37):
+        x = torch.randn(3, seq_len, 8)
+        hidden = torch.randn(1, 3, 6)
+        with torch.no_grad():
+            outputs, last_hidden = min_gru(x, hidden)
+            update_gates, candidates = min_gru.linears[0](x).chunk(2, 2)
+            expected = hidden[0]
+            for t in range(seq_len):
+                z = torch.sigmoid(update_gates[:, t])
+                expected = (1 - z) * expected + z * candidates[:, t]
+                assert torch.allclose(outputs[:, t], expected, atol=1e-5), 'Step {} of {} differs'.format(t, seq_len)
+            assert torch.allclose(last_hidden[0], expected, atol=1e-5)
+    print('MinGRU parallel scan matches the sequential recurrence')
 
 
 def test_encoder_decoder():
     train_data_path = '../data/2019/task2/UD_Afrikaans-AfriBooms/af_afribooms-um-train.conllu'
     from data_loaders import ConllDataset
-    from torch.utils.data import DataLoader
     from predict import predict_sentence
+    from data_utils import read_surfaces
 
-    train_set = ConllDataset(train_data_path, max_sentences=1)
-    train_loader = DataLoader(train_set)
+    train_set = ConllDataset(train_data_path, max_sentences=32)
+    train_loader = train_set.build_loader(batch_size=32, num_workers=0, pin_memory=False)
 
     encoder = EncoderRNN(10, 50, 50, len(train_set.surface_char2id))
     decoder_lemma = DecoderRNN(10, 50, train_set.lemma_char2id)
@@ -397,39 +604,41 @@ def test_encoder_decoder():
         encoder.train()
         decoder_lemma.train()
         decoder_morph_tags.train()
-        for ix, (x, y1, y2) in enumerate(train_loader):
+        for ix, (x, y1, y2, _) in enumerate(train_loader):
+            x, y1, y2 = x.long(), y1.long(), y2.long()
 
-            # Clear gradients for each sentence
+            # Clear gradients for each batch
             encoder.zero_grad()
             decoder_lemma.zero_grad()
             decoder_morph_tags.zero_grad()
 
-            # Run encoder
+            # Run encoder, words of all sentences in the batch are concatenated
             word_embeddings, context_embeddings = encoder(x)
+            mask = x[:, :, 0] != 0
 
-            # Run decoder for each word
-            sentence_loss = 0.0
+            # Run decoders for all words at once
+            batch_loss = 0.0
             for _y, decoder in zip([y1, y2], [decoder_lemma, decoder_morph_tags]):
-                decoder_outputs = decoder(word_embeddings, context_embeddings, _y[0, :, :-1])
-
-                for word_ix in range(word_embeddings.size(0)):
-                    sentence_loss += criterion(decoder_outputs[word_ix], _y[0, word_ix, 1:])
+                _y = _y[mask]
+                decoder_outputs = decoder(word_embeddings, context_embeddings, _y[:, :-1])
+                batch_loss += criterion(decoder_outputs.reshape(-1, decoder_outputs.size(-1)), _y[:, 1:].reshape(-1))
 
-                sentence_loss.backward(retain_graph=True)
+            # A single backward pass through the shared encoder for the losses of both decoders
+            batch_loss.backward()
 
-                # Optimization
-                encoder_optimizer.step()
-                decoder_lemma_optimizer.step()
-                decoder_morph_tags_optimizer.step()
+            # Optimization
+            encoder_optimizer.step()
+            decoder_lemma_optimizer.step()
+            decoder_morph_tags_optimizer.step()
 
     encoder.eval()
     decoder_lemma.eval()
     decoder_morph_tags.eval()
     # Make predictions and save to file
-    for sentence in train_set.sentences:
-        surface_words = [surface_word for surface_word in sentence.surface_words]
+    for surface_words in read_surfaces(train_data_path)[:1]:
         conll_sentence = predict_sentence(surface_words, encoder, decoder_lemma, decoder_morph_tags, train_set)
         print(conll_sentence)
 
 if __name__ == '__main__':
+    test_min_gru()
     test_encoder_decoder()
\ No newline at end of file
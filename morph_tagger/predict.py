@@ -1,19 +1,30 @@
 import pickle
 
-import re
+import numpy as np
 import torch
 import os
+import sys
+import threading
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 from tqdm import tqdm
 import optparse
+from data_loaders import ConllDataset, load_vocab
 from data_utils import read_surfaces, read_surface_lemma_map
 from languages import NON_TRANSFORMER_LANGUAGES
 from layers import EncoderRNN, DecoderRNN, TransformerRNN
 from logger import LOGGER
 from train import embedding_size, char_gru_hidden_size, word_gru_hidden_size, encoder_dropout, device, \
-    output_embedding_size, decoder_dropout
+    output_embedding_size, decoder_dropout, use_min_gru
 
-REMOVE_EOS_REGEX = re.compile(r'\$$')
+# Run prediction on gpu with fp16 autocast, ignored by torch versions without `torch.autocast`
+use_half_precision = False
+# Quantize linear and gru weights of the decoders to int8 for cpu prediction,
+# ignored by torch versions without dynamic quantization
+use_dynamic_quantization = False
 
 
 def predict_sentence(surface_words, encoder, decoder_lemma, decoder_morph_tags, dataset, device=torch.device("cpu"),
@@ -25,7 +36,7 @@ def predict_sentence(surface_words, encoder, decoder_lemma, decoder_morph_tags,
         encoder (`layers.EncoderRNN`): Encoder RNN
         decoder_lemma (`layers.TransformerRNN`): Lemma Decoder
         decoder_morph_tags (`layers.DecoderRNN`): Morphological Features Decoder
-        dataset (`torch.utils.data.Dataset`): Train Dataset. Required for vocab etc.
+        dataset (`torch.utils.data.Dataset`): Train Dataset or its `data_loaders.Vocab`. Required for vocab etc.
         device (`torch.device`): Default is cpu
         max_morph_features_len (int): Maximum length of morphological features
         surface2lemma (dict): Dictionary where keys are surface words and values are lemmas
@@ -36,194 +47,435 @@ def predict_sentence(surface_words, encoder, decoder_lemma, decoder_morph_tags,
         str: Predicted conll sentence
     """
 
-    if len(surface_words) == 0:
-        return ""
+    return predict_sentences([surface_words], encoder, decoder_lemma, decoder_morph_tags, dataset, device=device,
+                             max_morph_features_len=max_morph_features_len, surface2lemma=surface2lemma)[0]
 
-    max_token_len = max([len(surface) for surface in surface_words]) + 1
 
-    encoded_surfaces = torch.zeros((len(surface_words), max_token_len), dtype=torch.long)
-    for ix, surface in enumerate(surface_words):
-        encoded_surface = dataset.encode(surface, dataset.surface_char2id)
-        encoded_surfaces[ix, :encoded_surface.size()[0]] = encoded_surface
+def predict_sentences(sentences, encoder, decoder_lemma, decoder_morph_tags, dataset, device=torch.device("cpu"),
+                      max_morph_features_len=10, surface2lemma=None, batch_size=32, progress=False,
+                      half_precision=False):
+    """Predict many sentences with one encoder call per batch
 
-    encoded_surfaces = encoded_surfaces.to(device)
+    Sentences are bucketed by the length of their longest word, so every sentence is padded exactly as it is
+    when it is predicted on its own by `predict_sentence`.
 
-    # Run encoder
-    word_representations, context_aware_representations = encoder(encoded_surfaces.view(1, *encoded_surfaces.size()))
+    Args:
+        sentences (list): List of sentences where each sentence is a list of tokens (str)
+        batch_size (int): Maximum number of sentences encoded together
+        progress (bool): Show a progress bar over the batches, only when stderr is a terminal
+        half_precision (bool): Run the models with fp16 autocast on gpu
 
-    # Run lemma decoder for each word
-    words_count = context_aware_representations.size(0)
+        Other arguments are the same as `predict_sentence`
 
-    if isinstance(decoder_lemma, TransformerRNN):
-        _, lemmas = decoder_lemma.predict(word_representations, context_aware_representations,
-                                          encoded_surfaces.view(1, *encoded_surfaces.size()), surface_words)
-    else:
-        lemmas = []
-        for i in range(words_count):
-            _, lemma = decoder_lemma.predict(word_representations[i], context_aware_representations[i],
-                                             max_len=2 * max_token_len, device=device)
-            lemmas.append(''.join(lemma))
+    Returns:
+        list: Predicted conll sentences in the order of `sentences`
+    """
 
-    if surface2lemma:
+    buckets = defaultdict(list)
+    for sentence_ix, surface_words in enumerate(sentences):
+        if surface_words:
+            buckets[max(map(len, surface_words)) + 1].append(sentence_ix)
+
+    batches = [(max_token_len, sentence_ixs[start:start + batch_size])
+               for max_token_len, sentence_ixs in sorted(buckets.items())
+               for start in range(0, len(sentence_ixs), batch_size)]
+
+    context = _prediction_context(encoder, dataset, device)
+    # Buffers are taken here since batches are encoded on another thread
+    buffers, copy_stream = context.thread_buffers()
+
+    def encode_batch(indexed_batch):
+        batch_ix, (max_token_len, sentence_ixs) = indexed_batch
+        return _encode_batch([sentences[sentence_ix] for sentence_ix in sentence_ixs], max_token_len,
+                             context.surface_char_lut, context.surface_eos_id, device,
+                             buffers[batch_ix % 2], copy_stream)
+
+    conll_sentences = [""] * len(sentences)
+    with torch.no_grad(), _autocast(device, half_precision), ExitStack() as stack:
+        # The next batch is encoded in the background while the models run on the current one,
+        # a single batch is encoded without starting a thread
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=1)) if len(batches) > 1 else None
+        encoded_batches = _prefetch(executor, encode_batch, list(enumerate(batches)))
+        if progress and sys.stderr.isatty():
+            batches = tqdm(batches, mininterval=0.5, smoothing=0.1)
+        for (max_token_len, sentence_ixs), (encoded_surfaces, copied) in zip(batches, encoded_batches):
+            if copied is not None:
+                torch.cuda.current_stream().wait_event(copied)
+                # The buffer is allocated on the side stream, it must not be reused before the models are done
+                encoded_surfaces.record_stream(torch.cuda.current_stream())
+            batch = [sentences[sentence_ix] for sentence_ix in sentence_ixs]
+            batch_conll_sentences = _predict_batch(batch, max_token_len, encoded_surfaces, encoder, decoder_lemma,
+                                                   decoder_morph_tags, max_morph_features_len, surface2lemma)
+            for sentence_ix, conll_sentence in zip(sentence_ixs, batch_conll_sentences):
+                conll_sentences[sentence_ix] = conll_sentence
+    return conll_sentences
+
+
+def _prefetch(executor, function, items):
+    # Yields function(item) for each item while the result of the next item is computed by the executor
+    if executor is None:
+        for item in items:
+            yield function(item)
+        return
+    future = executor.submit(function, items[0]) if items else None
+    for ix in range(len(items)):
+        result = future.result()
+        if ix + 1 < len(items):
+            future = executor.submit(function, items[ix + 1])
+        yield result
+
+
+class _PredictionContext(object):
+    """State which is reused by the predictions of an encoder
+
+    Holds the lookup table of the surface characters, which is shared by all threads, and for each thread
+    the host buffers of the encoded surfaces and the stream of the copies to the gpu,
+    so predicting sentence by sentence does not create them every time.
+    """
 
-        modified_lemmas = []
-        for surface, lemma in zip(surface_words, lemmas):
-            if isinstance(decoder_lemma, TransformerRNN):
-                _surface = surface[:-1]
-            else:
-                _surface = surface
-            if _surface in surface2lemma and surface2lemma[_surface] != lemma:
-                modified_lemmas.append(surface2lemma[_surface])
-                # print('Changing {} to {}'.format(lemma, surface2lemma[_surface]))
-            else:
-                modified_lemmas.append(lemma)
-        lemmas = modified_lemmas
-
-    # Run morph features decoder for each word
-    morph_features = []
-    for i in range(words_count):
-        _, morph_feature = decoder_morph_tags.predict(word_representations[i], context_aware_representations[i],
-                                                      max_len=max_morph_features_len, device=device)
-        morph_features.append(';'.join(morph_feature))
-
-    conll_sentence = "# Sentence\n"
-    for i, (surface, lemma, morph_feature) in enumerate(zip(surface_words, lemmas, morph_features)):
-        conll_sentence += "{}\t{}\t{}\t_\t_\t{}\t_\t_\t_\t_\n".format(i + 1,
-                                                                      REMOVE_EOS_REGEX.sub('', surface),
-                                                                      lemma, morph_feature)
-    return conll_sentence
+    def __init__(self, dataset, device):
+        """
 
+        Args:
+            dataset (`torch.utils.data.Dataset`): Train Dataset or its `data_loaders.Vocab`
+            device (`torch.device`): Device of the models
+        """
+        self.surface_char2id = dataset.surface_char2id
+        self.vocab_size = len(dataset.surface_char2id)
+        self.surface_eos_id = dataset.surface_eos_id
+        self.device = torch.device(device)
+        self.surface_char_lut = ConllDataset._char_lut(dataset.surface_char2id)
+        self._thread_state = threading.local()
 
-def predict(input_file, output_file, dataset_obj_path, encoder_model_path, lemma_decoder_path, morph_decoder_path):
+    def thread_buffers(self):
+        """Host buffers and copy stream of the calling thread, they must not be shared with other predictions
+
+        Returns:
+            tuple: (two `_GrowOnlyBuffer`s, copy stream:`torch.cuda.Stream` or None on cpu)
+        """
+        state = self._thread_state
+        if not hasattr(state, 'buffers'):
+            # Copies to the gpu are issued on a side stream, so they overlap with the models running on a batch
+            state.copy_stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+            # Two buffers since a batch is encoded while the previous one is used by the models
+            state.buffers = (_GrowOnlyBuffer(pinned=state.copy_stream is not None),
+                             _GrowOnlyBuffer(pinned=state.copy_stream is not None))
+        return state.buffers, state.copy_stream
+
+    def matches(self, dataset, device):
+        return self.surface_char2id is dataset.surface_char2id and self.vocab_size == len(dataset.surface_char2id) \
+            and self.device == torch.device(device)
+
+
+# Prediction contexts of encoders, a context is released together with its encoder
+_PREDICTION_CONTEXTS = weakref.WeakKeyDictionary()
+
+
+def _prediction_context(encoder, dataset, device):
+    context = _PREDICTION_CONTEXTS.get(encoder)
+    if context is None or not context.matches(dataset, device):
+        context = _PREDICTION_CONTEXTS[encoder] = _PredictionContext(dataset, device)
+    return context
+
+
+def _autocast(device, enabled):
+    # An empty ExitStack is a context manager which does nothing
+    if enabled and torch.device(device).type == 'cuda' and hasattr(torch, 'autocast'):
+        return torch.autocast('cuda', dtype=torch.float16)
+    return ExitStack()
+
+
+def _encode_batch(sentences, max_token_len, surface_char_lut, surface_eos_id, device, buffer, copy_stream=None):
+    """Encode the surfaces of a batch into a (sentence, word, char) tensor on device
+
+    Returns:
+        tuple: (encoded surfaces:`torch.tensor`, copied:`torch.cuda.Event`)
+            copied is recorded on `copy_stream` after the copy, None if there is no copy stream
+            On cpu the encoded surfaces share memory with `buffer`
     """
+    surface_words = [surface for sentence in sentences for surface in sentence]
+    # Word counts are computed once and reused for the buffer shape and the rows of the words
+    words_counts = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+    max_words_count = int(words_counts.max())
+
+    # Encode all words at once and scatter the characters into a zero padded (sentence, word, char) buffer
+    values, offsets = ConllDataset._encode_chars(surface_words, surface_char_lut, end_id=surface_eos_id,
+                                                 dtype=np.int64)
+    lengths = np.diff(offsets)
+    sentence_starts = np.cumsum(words_counts) - words_counts
+    word_rows = np.repeat(np.arange(len(sentences)) * max_words_count - sentence_starts, words_counts) + \
+        np.arange(len(surface_words))
+    rows = np.repeat(word_rows, lengths)
+    columns = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
+    encoded_surfaces = buffer.zeros(len(sentences) * max_words_count, max_token_len)
+    encoded_surfaces.numpy()[rows, columns] = values
+
+    encoded_surfaces = encoded_surfaces.view(len(sentences), max_words_count, max_token_len)
+    if copy_stream is None:
+        return encoded_surfaces.to(device), None
+
+    # The buffer is in pinned host memory, so the copy to the gpu runs asynchronously
+    with torch.cuda.stream(copy_stream):
+        encoded_surfaces = encoded_surfaces.to(device, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(copy_stream)
+    return encoded_surfaces, copied
+
+
+class _GrowOnlyBuffer(object):
+    """Flat int64 host buffer which is reallocated only when a larger size is requested"""
+
+    def __init__(self, pinned=False):
+        """
+
+        Args:
+            pinned (bool): Allocate the buffer in pinned memory for asynchronous copies to the gpu
+        """
+        self.pinned = pinned
+        self.buffer = torch.empty(0, dtype=torch.long)
+
+    def zeros(self, *shape):
+        """Zeroed view of the buffer with the given shape, the view is overwritten by the next call"""
+        size = int(np.prod(shape))
+        if self.buffer.numel() < size:
+            self.buffer = torch.empty(size, dtype=torch.long)
+            if self.pinned:
+                self.buffer = self.buffer.pin_memory()
+        view = self.buffer[:size].view(*shape)
+        view.zero_()
+        return view
+
+
+def _predict_batch(sentences, max_token_len, encoded_surfaces, encoder, decoder_lemma, decoder_morph_tags,
+                   max_morph_features_len, surface2lemma):
+    surface_words = [surface for sentence in sentences for surface in sentence]
+    # Surfaces without the end of sentence character, the eos is a single known character so it is sliced off
+    stripped_surfaces = [surface[:-1] if surface.endswith('$') else surface for surface in surface_words]
+
+    # Run encoder, outputs of all words in the batch are concatenated
+    word_representations, context_aware_representations = encoder(encoded_surfaces)
+
+    # Run lemma decoder for all words at once
+    if isinstance(decoder_lemma, TransformerRNN):
+        encoded_words = encoded_surfaces[encoded_surfaces[:, :, 0] != 0]
+        _, lemmas = decoder_lemma.predict(word_representations, context_aware_representations,
+                                          encoded_words.unsqueeze(0), surface_words)
+    else:
+        lemmas = [''.join(lemma) for lemma in decoder_lemma.predict_batch(word_representations,
+                                                                         context_aware_representations,
+                                                                         max_len=2 * max_token_len)]
+
+    # Lemmas of the surfaces found in the mapping replace the predicted ones, its keys have no eos
+    if surface2lemma:
+        lemmas = [surface2lemma.get(surface, lemma) for surface, lemma in zip(stripped_surfaces, lemmas)]
+
+    # Run morph features decoder for all words at once
+    morph_features = [';'.join(morph_feature)
+                      for morph_feature in decoder_morph_tags.predict_batch(word_representations,
+                                                                            context_aware_representations,
+                                                                            max_len=max_morph_features_len)]
+
+    conll_sentences = []
+    start = 0
+    for sentence in sentences:
+        end = start + len(sentence)
+        rows = ["# Sentence"]
+        rows.extend("{}\t{}\t{}\t_\t_\t{}\t_\t_\t_\t_".format(i + 1, surface, lemma, morph_feature)
+                    for i, (surface, lemma, morph_feature) in enumerate(zip(stripped_surfaces[start:end],
+                                                                            lemmas[start:end],
+                                                                            morph_features[start:end])))
+        conll_sentences.append("\n".join(rows) + "\n")
+        start = end
+    return conll_sentences
+
+
+def load_models(dataset_obj_path, encoder_model_path, lemma_decoder_path, morph_decoder_path,
+                use_min_edit_operation_decoder=True):
+    """Load the dataset object and the models which are saved during training process
 
     Args:
-        input_file (str): Input conll file path. Tab separated format. Second column contains surface words.
-            Other columns are ignored, could be empty. Total 10 columns.
-        output_file (str): Output conll file path. Second column contains surface words.
-            Third column contains lemmata and sixth column contains morphological tags.
-        dataset_obj_path (str): The path of the dataset object which is saved during training process
-        encoder_model_path (str): The path of the encoder model which is saved during training process
-        lemma_decoder_path (str): The path of the lemma decoder model which is saved during training process
-        morph_decoder_path (str): The path of the morph decoder model which is saved during training process
+        dataset_obj_path (str): The path of the dataset object
+        encoder_model_path (str): The path of the encoder model
+        lemma_decoder_path (str): The path of the lemma decoder model
+        morph_decoder_path (str): The path of the morph decoder model
+        use_min_edit_operation_decoder (bool): The lemma decoder is a `TransformerRNN` if True,
+            a character `DecoderRNN` otherwise
 
+    Returns:
+        tuple: (train_set, encoder, decoder_lemma, decoder_morph_tags) models are in eval mode
+            train_set is a `data_loaders.Vocab` if the vocabs are saved next to the dataset object
     """
 
-    LOGGER.info('Loading dataset obj...')
-    with open(dataset_obj_path, 'rb') as f:
-        train_set = pickle.load(f)
+    # Vocabs saved next to the dataset object are loaded instead of the whole dataset
+    vocab_path = os.path.splitext(dataset_obj_path)[0] + '.vocab'
+    if os.path.exists(vocab_path):
+        LOGGER.info('Loading vocabs...')
+        train_set = load_vocab(vocab_path)
+    else:
+        LOGGER.info('Loading dataset obj...')
+        with open(dataset_obj_path, 'rb') as f:
+            train_set = pickle.load(f)
 
     # LOAD ENCODER MODEL
     LOGGER.info('Loading Encoder...')
     encoder = EncoderRNN(embedding_size, char_gru_hidden_size, word_gru_hidden_size,
-                         len(train_set.surface_char2id), dropout_ratio=encoder_dropout, device=device)
-    encoder.load_state_dict(torch.load(encoder_model_path))
-    encoder = encoder.to(device)
+                         len(train_set.surface_char2id), dropout_ratio=encoder_dropout, device=device).to(device)
+    encoder.load_state_dict(torch.load(encoder_model_path, map_location=device))
 
     # LOAD LEMMA DECODER MODEL
     LOGGER.info('Loading Lemma Decoder...')
 
-    decoder_lemma = TransformerRNN(output_embedding_size, word_gru_hidden_size, train_set.transformation2id,
-                                   len(train_set.surface_char2id), dropout_ratio=decoder_dropout).to(device)
+    if use_min_edit_operation_decoder:
+        decoder_lemma = TransformerRNN(output_embedding_size, word_gru_hidden_size, train_set.transformation2id,
+                                       len(train_set.surface_char2id), dropout_ratio=decoder_dropout,
+                                       use_min_gru=use_min_gru).to(device)
+    else:
+        decoder_lemma = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.lemma_char2id,
+                                   dropout_ratio=decoder_dropout, use_min_gru=use_min_gru).to(device)
 
-    decoder_lemma.load_state_dict(torch.load(lemma_decoder_path))
-    decoder_lemma = decoder_lemma.to(device)
+    decoder_lemma.load_state_dict(torch.load(lemma_decoder_path, map_location=device))
 
     # LOAD MORPH DECODER MODEL
     LOGGER.info('Loading Morph Decoder...')
     decoder_morph_tags = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.morph_tag2id,
-                                    dropout_ratio=decoder_dropout).to(device)
-    decoder_morph_tags.load_state_dict(torch.load(morph_decoder_path))
-    decoder_morph_tags = decoder_morph_tags.to(device)
+                                    dropout_ratio=decoder_dropout, use_min_gru=use_min_gru).to(device)
+    decoder_morph_tags.load_state_dict(torch.load(morph_decoder_path, map_location=device))
 
     encoder.eval()
     decoder_lemma.eval()
     decoder_morph_tags.eval()
 
+    if use_dynamic_quantization and torch.device(device).type == 'cpu':
+        decoder_lemma = _quantize_dynamic(decoder_lemma)
+        decoder_morph_tags = _quantize_dynamic(decoder_morph_tags)
+
+    return train_set, encoder, decoder_lemma, decoder_morph_tags
+
+
+def _quantize_dynamic(model):
+    quantization = getattr(getattr(torch, 'ao', None), 'quantization', None) or getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        return model
+    return quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.GRU}, dtype=torch.qint8)
+
+
+def predict_documents(docs, models, surface2lemma=None, batch_size=32, progress=False):
+    """Predict lemmata and morphological tags of tokenized sentences without any file I/O
+
+    All sentences are batched together regardless of the document they come from.
+
+    Args:
+        docs (list): List of sentences where each sentence is a list of surface words (str)
+            with the end of sentence character if the models are trained with it
+        models (tuple): (train_set, encoder, decoder_lemma, decoder_morph_tags) as returned by `load_models`
+        surface2lemma (dict): Dictionary where keys are surface words and values are lemmas
+        batch_size (int): Maximum number of sentences encoded together
+        progress (bool): Show a progress bar over the batches
+
+    Returns:
+        list: Predicted conll sentences in the order of `docs`
+    """
+    train_set, encoder, decoder_lemma, decoder_morph_tags = models
+    return predict_sentences(docs, encoder, decoder_lemma, decoder_morph_tags, train_set, device=device,
+                             surface2lemma=surface2lemma, batch_size=batch_size, progress=progress,
+                             half_precision=use_half_precision)
+
+
+def predict(input_file, output_file, dataset_obj_path, encoder_model_path, lemma_decoder_path, morph_decoder_path):
+    """
+
+    Args:
+        input_file (str): Input conll file path. Tab separated format. Second column contains surface words.
+            Other columns are ignored, could be empty. Total 10 columns.
+        output_file (str): Output conll file path. Second column contains surface words.
+            Third column contains lemmata and sixth column contains morphological tags.
+        dataset_obj_path (str): The path of the dataset object which is saved during training process
+        encoder_model_path (str): The path of the encoder model which is saved during training process
+        lemma_decoder_path (str): The path of the lemma decoder model which is saved during training process
+        morph_decoder_path (str): The path of the morph decoder model which is saved during training process
+
+    """
+
+    models = load_models(dataset_obj_path, encoder_model_path, lemma_decoder_path, morph_decoder_path)
+
     # Make predictions and save to file
     data_surface_words = read_surfaces(input_file)
     with open(output_file, 'w', encoding='UTF-8') as f:
-        for sentence in tqdm(data_surface_words):
-            conll_sentence = predict_sentence(sentence, encoder, decoder_lemma, decoder_morph_tags,
-                                              train_set, device=device, surface2lemma=dict())
+        for conll_sentence in predict_documents(data_surface_words, models, surface2lemma=dict(), progress=True):
             f.write(conll_sentence)
             f.write('\n')
 
 
+# Datasets and models last loaded by predict_unimorph, they are reloaded when their files change.
+# Only the most recent language is kept so that training languages one after another does not pile up models.
+_UNIMORPH_MODELS = dict()
+
+
+def _load_unimorph_models(language_path, train_data_path, model_name, use_min_edit_operation_decoder):
+    """Load the dataset object and the models trained on the train file of a language
+
+    Returns:
+        tuple: (train_set, encoder, decoder_lemma, decoder_morph_tags)
+    """
+    dataset_path = train_data_path.replace('-train', '').replace('conllu', '{}.dataset'.format(model_name))
+    encoder_path, lemma_decoder_path, morph_decoder_path = [
+        train_data_path.replace('train', name).replace('conllu', '{}.model'.format(model_name))
+        for name in ('encoder', 'decoder_lemma', 'decoder_morph')
+    ]
+    use_char_decoder = any([l in language_path for l in NON_TRANSFORMER_LANGUAGES]) or \
+        not use_min_edit_operation_decoder
+
+    paths = (dataset_path, encoder_path, lemma_decoder_path, morph_decoder_path)
+    mtimes = [os.path.getmtime(path) for path in paths]
+    cached = _UNIMORPH_MODELS.get((paths, use_char_decoder))
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+
+    # Release the models of the previous language before loading new ones
+    _UNIMORPH_MODELS.clear()
+    models = load_models(dataset_path, encoder_path, lemma_decoder_path, morph_decoder_path,
+                         use_min_edit_operation_decoder=not use_char_decoder)
+    _UNIMORPH_MODELS[(paths, use_char_decoder)] = (mtimes, models)
+    return models
+
+
 def predict_unimorph(language_path, model_name, conll_file, use_surface_lemma_mapping=True,
                      prediction_file=None, use_min_edit_operation_decoder=True,):
 
+    # Only the first train file of the language is used
     language_conll_files = os.listdir(language_path)
     for language_conll_file in language_conll_files:
         if 'train.' in language_conll_file:
+            break
+    else:
+        return
+
+    train_data_path = language_path + '/' + language_conll_file
+
+    surface2lemma = None
+    if use_surface_lemma_mapping:
+        surface2lemma = read_surface_lemma_map(train_data_path)
+        print('Surface Lemma Mapping Length: {}'.format(len(surface2lemma)))
+
+    if any([l in language_path for l in NON_TRANSFORMER_LANGUAGES]):
+        add_eos = False
+    else:
+        add_eos = True
+    if language_path in conll_file:
+        data_surface_words = read_surfaces(conll_file, add_eos=add_eos)
+    else:
+        data_surface_words = read_surfaces(language_path + '/' + conll_file, add_eos=add_eos)
+
+    models = _load_unimorph_models(language_path, train_data_path, model_name, use_min_edit_operation_decoder)
 
-            # LOAD DATASET
-            LOGGER.info('Loading dataset...')
-            train_data_path = language_path + '/' + language_conll_file
-
-            surface2lemma = None
-            if use_surface_lemma_mapping:
-                surface2lemma = read_surface_lemma_map(train_data_path)
-                print('Surface Lemma Mapping Length: {}'.format(len(surface2lemma)))
-
-            with open(train_data_path.replace('-train', '').replace('conllu', '{}.dataset'.format(model_name)),
-                      'rb') as f:
-                train_set = pickle.load(f)
-            if any([l in language_path for l in NON_TRANSFORMER_LANGUAGES]):
-                add_eos = False
-            else:
-                add_eos = True
-            if language_path in conll_file:
-                data_surface_words = read_surfaces(conll_file, add_eos=add_eos)
-            else:
-                data_surface_words = read_surfaces(language_path + '/' + conll_file, add_eos=add_eos)
-
-            # LOAD ENCODER MODEL
-            LOGGER.info('Loading Encoder...')
-            encoder = EncoderRNN(embedding_size, char_gru_hidden_size, word_gru_hidden_size,
-                                 len(train_set.surface_char2id), dropout_ratio=encoder_dropout, device=device)
-            encoder.load_state_dict(torch.load(
-                train_data_path.replace('train', 'encoder').replace('conllu', '{}.model'.format(model_name))
-            ))
-            encoder = encoder.to(device)
-
-            # LOAD LEMMA DECODER MODEL
-            LOGGER.info('Loading Lemma Decoder...')
-
-            if any([l in language_path for l in NON_TRANSFORMER_LANGUAGES]) or not use_min_edit_operation_decoder:
-                decoder_lemma = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.lemma_char2id,
-                                           dropout_ratio=decoder_dropout).to(device)
-            else:
-                decoder_lemma = TransformerRNN(output_embedding_size, word_gru_hidden_size, train_set.transformation2id,
-                                               len(train_set.surface_char2id), dropout_ratio=decoder_dropout).to(device)
-
-            decoder_lemma.load_state_dict(torch.load(
-                train_data_path.replace('train', 'decoder_lemma').replace('conllu', '{}.model'.format(model_name))
-            ))
-            decoder_lemma = decoder_lemma.to(device)
-
-            # LOAD MORPH DECODER MODEL
-            LOGGER.info('Loading Morph Decoder...')
-            decoder_morph_tags = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.morph_tag2id,
-                                            dropout_ratio=decoder_dropout).to(device)
-            decoder_morph_tags.load_state_dict(torch.load(
-                train_data_path.replace('train', 'decoder_morph').replace('conllu', '{}.model'.format(model_name))
-            ))
-            decoder_morph_tags = decoder_morph_tags.to(device)
-
-            encoder.eval()
-            decoder_lemma.eval()
-            decoder_morph_tags.eval()
-
-            # Make predictions and save to file
-            if not prediction_file:
-                prediction_file = train_data_path.replace('train', 'predictions-{}'.format(model_name))
-            with open(prediction_file, 'w', encoding='UTF-8') as f:
-                for sentence in tqdm(data_surface_words):
-                    conll_sentence = predict_sentence(sentence, encoder, decoder_lemma, decoder_morph_tags,
-                                                      train_set, device=device, surface2lemma=surface2lemma)
-                    f.write(conll_sentence)
-                    f.write('\n')
+    # Make predictions and save to file
+    if not prediction_file:
+        prediction_file = train_data_path.replace('train', 'predictions-{}'.format(model_name))
+    with open(prediction_file, 'w', encoding='UTF-8') as f:
+        for conll_sentence in predict_documents(data_surface_words, models, surface2lemma=surface2lemma,
+                                                progress=True):
+            f.write(conll_sentence)
+            f.write('\n')
 
 
 if __name__ == '__main__':
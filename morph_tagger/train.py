@@ -4,11 +4,10 @@ import pickle
 import torch
 import torch.nn as nn
 from torch.optim.lr_scheduler import MultiStepLR
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 import optparse
 
-from data_loaders import ConllDataset
+from data_loaders import ConllDataset, save_vocab
 from eval import evaluate
 from languages import PILOT_LANGUAGES, NON_TRANSFORMER_LANGUAGES
 from layers import EncoderRNN, DecoderRNN, TransformerRNN
@@ -23,6 +22,11 @@ encoder_dropout = 0.5
 # Decoder hyper-parmeters
 output_embedding_size = 256
 decoder_dropout = 0.5
+# Use minGRU layers which are trained in parallel over time steps instead of GRU layers in decoders
+use_min_gru = False
+
+# Number of worker processes which prepare batches, 0 prepares them in the training process
+num_loader_workers = min(4, os.cpu_count() or 1)
 
 # Select cuda as device if available
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -54,13 +58,13 @@ def train(language_name, train_data_path, val_data_path, use_min_edit_operation_
     """
     # Load train set
     train_set = ConllDataset(train_data_path)
-    train_loader = DataLoader(train_set)
+    train_loader = train_set.build_loader(num_workers=num_loader_workers, pin_memory=device.type == 'cuda')
 
     # Load validation data
     val_set = ConllDataset(val_data_path, surface_char2id=train_set.surface_char2id,
                            lemma_char2id=train_set.lemma_char2id, morph_tag2id=train_set.morph_tag2id,
                            transformation2id=train_set.transformation2id, mode='test')
-    val_loader = DataLoader(val_set)
+    val_loader = val_set.build_loader(num_workers=num_loader_workers, pin_memory=device.type == 'cuda')
 
     # Build Models
     # Initialize encoder and decoders
@@ -72,13 +76,14 @@ def train(language_name, train_data_path, val_data_path, use_min_edit_operation_
 
     if language_name in NON_TRANSFORMER_LANGUAGES or not use_min_edit_operation_decoder:
         decoder_lemma = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.lemma_char2id,
-                                   dropout_ratio=decoder_dropout).to(device)
+                                   dropout_ratio=decoder_dropout, use_min_gru=use_min_gru).to(device)
     else:
         decoder_lemma = TransformerRNN(output_embedding_size, word_gru_hidden_size, train_set.transformation2id,
-                                       len(train_set.surface_char2id), dropout_ratio=decoder_dropout).to(device)
+                                       len(train_set.surface_char2id), dropout_ratio=decoder_dropout,
+                                       use_min_gru=use_min_gru).to(device)
 
     decoder_morph_tags = DecoderRNN(output_embedding_size, word_gru_hidden_size, train_set.morph_tag2id,
-                                    dropout_ratio=decoder_dropout).to(device)
+                                    dropout_ratio=decoder_dropout, use_min_gru=use_min_gru).to(device)
 
     # Define loss and optimizers
     criterion = nn.CrossEntropyLoss(ignore_index=0).to(device)
@@ -127,11 +132,11 @@ def train(language_name, train_data_path, val_data_path, use_min_edit_operation_
             decoder_lemma.zero_grad()
             decoder_morph_tags.zero_grad()
 
-            # Send input to the device
-            x = x.to(device)
-            y1 = y1.to(device)
-            y2 = y2.to(device)
-            y3 = y3.to(device)
+            # Send input to the device, ids are cast to long on the device
+            x = x.to(device, non_blocking=True).long()
+            y1 = y1.to(device, non_blocking=True).long()
+            y2 = y2.to(device, non_blocking=True).long()
+            y3 = y3.to(device, non_blocking=True).long()
 
             # Run encoder
             word_embeddings, context_embeddings = encoder(x)
@@ -175,11 +180,11 @@ def train(language_name, train_data_path, val_data_path, use_min_edit_operation_
             if x.size(1) > max_words:
                 continue
 
-            # Send input to the device
-            x = x.to(device)
-            y1 = y1.to(device)
-            y2 = y2.to(device)
-            y3 = y3.to(device)
+            # Send input to the device, ids are cast to long on the device
+            x = x.to(device, non_blocking=True).long()
+            y1 = y1.to(device, non_blocking=True).long()
+            y2 = y2.to(device, non_blocking=True).long()
+            y3 = y3.to(device, non_blocking=True).long()
 
             # Run encoder
             word_embeddings, context_embeddings = encoder(x)
@@ -244,6 +249,8 @@ def train(language_name, train_data_path, val_data_path, use_min_edit_operation_
             with open(train_data_path.replace('-train', '').replace('conllu', '{}.dataset'.format(model_name)),
                       'wb') as f:
                 pickle.dump(train_set, f)
+            save_vocab(train_set,
+                       train_data_path.replace('-train', '').replace('conllu', '{}.vocab'.format(model_name)))
 
     # Make predictions and save to file
     LOGGER.info('Training completed')